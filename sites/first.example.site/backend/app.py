@@ -1,12 +1,48 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify, g, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import requests
 import jwt  # For decoding tokens locally
 from flasgger import Swagger  # Import Swagger
 import sqlite3, json, os
 from flask_cors import CORS  # Import CORS
 import time
+import hashlib, heapq, threading, weakref
+import click
+
+try:
+    import orjson  # Optional: much faster than the stdlib encoder
+except ImportError:
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes and decodes with orjson.
+
+    Dates are handed back to Flask's default handler, so they serialize the
+    same way as with the stdlib provider. Output is always compact: options
+    passed to dumps() such as indent are ignored.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return self._encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._encode(obj), mimetype=self.mimetype)
+
+    def _encode(self, obj):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 CORS(app)
 
 swagger = Swagger(
@@ -22,58 +58,253 @@ KEYCLOAK_PUBLIC_KEY_URL = "https://sso.example.org/realms/demo-sso-realm"
 
 DATABASE = "university.db"
 
+# Number of SQLite files the students table is partitioned across (by email hash).
+# With a single shard everything stays in DATABASE, as before.
+STUDENT_SHARDS = int(os.environ.get("STUDENT_SHARDS", "1"))
+if STUDENT_SHARDS < 1:
+    raise ValueError(f"STUDENT_SHARDS must be at least 1, got {STUDENT_SHARDS}")
+
+# One write lock per shard, so writers on different shards never wait on each other
+SHARD_LOCKS = [threading.Lock() for _ in range(STUDENT_SHARDS)]
+
+# Set once the serving process has created any missing shard tables
+shards_ready = False
+
 CLIENT_ID = 'first.example.org'
 
+STUDENT_COLUMNS = [
+    "id",
+    "email",
+    "name",
+    "course",
+    "enrollment_date",
+    "expected_graduation",
+    "gpa",
+    "credits_completed",
+    "major",
+    "minor",
+]
+
+
+def shard_path(index, shards=None):
+    """Return the SQLite file holding shard `index` out of `shards`."""
+    shards = STUDENT_SHARDS if shards is None else shards
+    if shards == 1:
+        return DATABASE
+    root, ext = os.path.splitext(DATABASE)
+    return f"{root}_{index}{ext}"
+
+
+def shard_for(email, shards=None):
+    """Map an email to its shard index with a hash that is stable across processes."""
+    shards = STUDENT_SHARDS if shards is None else shards
+    digest = hashlib.sha1(email.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def connect_shard(path):
+    db = sqlite3.connect(path, timeout=30)
+    # WAL lets readers keep going while the shard's single writer commits
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
 
-def get_db():
-    db = getattr(g, "_database", None)
+# cursor -> (description, column names), so names are built once per result set
+_row_columns = weakref.WeakKeyDictionary()
+
+
+def dict_row(cursor, row):
+    """Row factory that builds each row straight into a JSON-ready dict."""
+    description = cursor.description
+    cached = _row_columns.get(cursor)
+    if cached is None or cached[0] is not description:
+        cached = _row_columns[cursor] = (description, [col[0] for col in description])
+    return dict(zip(cached[1], row))
+
+
+def get_db(index=0):
+    global shards_ready
+    if not shards_ready:
+        ensure_shards()
+        shards_ready = True
+    databases = getattr(g, "_databases", None)
+    if databases is None:
+        databases = g._databases = {}
+    db = databases.get(index)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
+        db = databases[index] = connect_shard(shard_path(index))
+        db.row_factory = dict_row
     return db
 
 
-def query_db(query, args=(), one=False):
-    cur = get_db().execute(query, args)
+def get_shard(email):
+    """Return the (connection, write lock) pair owning `email`."""
+    index = shard_for(email)
+    return get_db(index), SHARD_LOCKS[index]
+
+
+def query_db(query, args=(), one=False, email=None):
+    db = get_db() if email is None else get_shard(email)[0]
+    cur = db.execute(query, args)
     rv = cur.fetchall()
     cur.close()
     return (rv[0] if rv else None) if one else rv
 
 
-def init_db():
-    with app.app_context():
-        db = get_db()
-        db.execute("DROP TABLE IF EXISTS students")
-        db.execute(
-            """
-            CREATE TABLE IF NOT EXISTS students (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE NOT NULL,
-                name TEXT NOT NULL,
-                course TEXT NOT NULL,
-                enrollment_date TEXT NOT NULL,
-                expected_graduation TEXT,
-                gpa FLOAT DEFAULT 0.0,
-                credits_completed INTEGER DEFAULT 0,
-                major TEXT NOT NULL,
-                minor TEXT
-            )
+def query_all_shards(query, args=(), key=None):
+    """Run `query` on every shard and lazily yield the merged rows.
+
+    When `key` is given, each shard's rows must already be sorted by it and
+    the merged result keeps that order.
+    """
+    cursors = [get_db(index).execute(query, args) for index in range(STUDENT_SHARDS)]
+    try:
+        if key is None:
+            for cur in cursors:
+                yield from cur
+        else:
+            yield from heapq.merge(*cursors, key=key)
+    finally:
+        for cur in cursors:
+            cur.close()
+
+
+def stream_json_list(rows, **envelope):
+    """Stream `{**envelope, "data": [...rows]}` without building the list in memory."""
+
+    def generate():
+        head = app.json.dumps(envelope)[:-1]
+        yield head + ("," if envelope else "") + '"data":['
+        for i, row in enumerate(rows):
+            yield ("," if i else "") + app.json.dumps(row)
+        yield "]}"
+
+    return app.response_class(
+        stream_with_context(generate()), mimetype=app.json.mimetype
+    )
+
+
+def create_students_table(db):
+    db.execute(
         """
+        CREATE TABLE IF NOT EXISTS students (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            name TEXT NOT NULL,
+            course TEXT NOT NULL,
+            enrollment_date TEXT NOT NULL,
+            expected_graduation TEXT,
+            gpa FLOAT DEFAULT 0.0,
+            credits_completed INTEGER DEFAULT 0,
+            major TEXT NOT NULL,
+            minor TEXT
         )
+    """
+    )
+
+
+def ensure_shards():
+    """Create the students table in any shard file that does not have it yet."""
+    for index in range(STUDENT_SHARDS):
+        db = connect_shard(shard_path(index))
+        create_students_table(db)
         db.commit()
+        db.close()
+
+
+
+def init_db():
+    with app.app_context():
+        for index in range(STUDENT_SHARDS):
+            db = get_db(index)
+            db.execute("DROP TABLE IF EXISTS students")
+            create_students_table(db)
+            db.commit()
 
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, "_database", None)
-    if db is not None:
+    databases = getattr(g, "_databases", None)
+    if databases is not None:
+        for db in databases.values():
+            db.close()
+
+
+@app.after_request
+def set_cache_headers(response):
+    # Every API response is per-user; the public SPA is served by nginx
+    response.headers["Cache-Control"] = "private, no-store"
+    response.vary.add("Authorization")
+    return response
+
+
+@app.cli.command("rebalance-shards")
+@click.option("--from-shards", type=int, required=True, help="Current shard count.")
+@click.option("--to-shards", type=int, required=True, help="New shard count.")
+def rebalance_shards(from_shards, to_shards):
+    """Move students rows so they match a new STUDENT_SHARDS value.
+
+    Stop the app before running this: writes made while rows are moving, or
+    with the old STUDENT_SHARDS afterwards, end up on shards nobody reads.
+
+    Rows are copied to their new shard before being deleted from the old one,
+    so an interrupted run can simply be started again. A row whose email is
+    already on the target shard with different data is reported and left in
+    place. Ids are shard-local: moved rows get a new id from the target shard.
+    """
+    targets = [connect_shard(shard_path(i, to_shards)) for i in range(to_shards)]
+    for db in targets:
+        create_students_table(db)
+        db.commit()
+
+    fields = STUDENT_COLUMNS[1:]
+    insert = (
+        f"INSERT INTO students ({', '.join(fields)}) "
+        f"VALUES ({', '.join('?' for _ in fields)})"
+    )
+    existing = f"SELECT {', '.join(fields)} FROM students WHERE email = ?"
+    moved = conflicts = 0
+    for index in range(from_shards):
+        path = shard_path(index, from_shards)
+        if not os.path.exists(path):
+            continue
+        source = connect_shard(path)
+        create_students_table(source)
+        rows = source.execute(f"SELECT {', '.join(fields)} FROM students").fetchall()
+        leaving = []
+        for row in rows:
+            target = shard_for(row[0], to_shards)
+            if shard_path(target, to_shards) == path:
+                continue
+            try:
+                targets[target].execute(insert, row)
+            except sqlite3.IntegrityError:
+                # Already copied by an interrupted run, or a genuine conflict
+                if targets[target].execute(existing, (row[0],)).fetchone() != row:
+                    click.echo(f"{path}: conflict for {row[0]}, left in place", err=True)
+                    conflicts += 1
+                    continue
+            leaving.append((row[0],))
+        for db in targets:
+            db.commit()
+        source.executemany("DELETE FROM students WHERE email = ?", leaving)
+        source.commit()
+        source.close()
+        moved += len(leaving)
+        click.echo(f"{path}: moved {len(leaving)} of {len(rows)} rows")
+
+    for db in targets:
         db.close()
+    click.echo(
+        f"Rebalanced {from_shards} -> {to_shards} shards, {moved} rows moved, "
+        f"{conflicts} conflicts"
+    )
 
 
 # Initialize the database
 # init_db()
 
 def get_keycloak_public_key(retries=5, delay=5):
-    time.sleep(5) # Wait for Keycloak to start
     for attempt in range(retries):
         try:
             response = requests.get(KEYCLOAK_PUBLIC_KEY_URL)
@@ -89,7 +320,15 @@ def get_keycloak_public_key(retries=5, delay=5):
                 print("Failed to fetch public key after retries.")
                 return None
 
-PUBLIC_KEY = get_keycloak_public_key()
+PUBLIC_KEY = None
+
+
+def get_public_key():
+    """Fetch Keycloak's public key on first use, so CLI commands never wait for it."""
+    global PUBLIC_KEY
+    if PUBLIC_KEY is None:
+        PUBLIC_KEY = get_keycloak_public_key()
+    return PUBLIC_KEY
 
 
 def validate_token(token):
@@ -99,7 +338,7 @@ def validate_token(token):
 
         claims = jwt.decode(
             token,
-            PUBLIC_KEY,
+            get_public_key(),
             algorithms=["RS256"],
             options={"verify_aud": False},
         )
@@ -133,6 +372,10 @@ def get_resource():
                 properties:
                   id:
                     type: integer
+                    description: >-
+                      Row id within the student's shard. Not unique across
+                      shards and reassigned by rebalance-shards; use email
+                      to identify a student.
                   email:
                     type: string
                   name:
@@ -175,35 +418,12 @@ def get_resource():
     if not email:
         return jsonify({"error": "Email not found in token"}), 401
 
-    # Get column names from the students table
-    columns = [
-        "id",
-        "email",
-        "name",
-        "course",
-        "enrollment_date",
-        "expected_graduation",
-        "gpa",
-        "credits_completed",
-        "major",
-        "minor",
-    ]
-
-    students = query_db("SELECT * FROM students WHERE email = ?", [email])
-
-    # Transform the data into a list of dictionaries
-    formatted_students = []
-    for student in students:
-        student_dict = {columns[i]: student[i] for i in range(len(columns))}
-        formatted_students.append(student_dict)
-
-    return jsonify(
-        {
-            "message": "GET request successful",
-            "data": formatted_students[0] if formatted_students else None,
-        }
+    student = query_db(
+        "SELECT * FROM students WHERE email = ?", [email], one=True, email=email
     )
 
+    return jsonify({"message": "GET request successful", "data": student})
+
 
 @app.route("/api/resource", methods=["POST"])
 def post_resource():
@@ -283,27 +503,28 @@ def post_resource():
 
     data = request.json
     try:
-        db = get_db()
-        db.execute(
-            """
-            INSERT INTO students (
-                email, name, course, enrollment_date, expected_graduation,
-                gpa, credits_completed, major, minor
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-            [
-                email,
-                data["name"],
-                data["course"],
-                data["enrollment_date"],
-                data.get("expected_graduation"),  # Optional field
-                data.get("gpa", 0.0),  # Default to 0.0 if not provided
-                data.get("credits_completed", 0),  # Default to 0 if not provided
-                data["major"],
-                data.get("minor"),  # Optional field
-            ],
-        )
-        db.commit()
+        db, lock = get_shard(email)
+        with lock:
+            db.execute(
+                """
+                INSERT INTO students (
+                    email, name, course, enrollment_date, expected_graduation,
+                    gpa, credits_completed, major, minor
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+                [
+                    email,
+                    data["name"],
+                    data["course"],
+                    data["enrollment_date"],
+                    data.get("expected_graduation"),  # Optional field
+                    data.get("gpa", 0.0),  # Default to 0.0 if not provided
+                    data.get("credits_completed", 0),  # Default to 0 if not provided
+                    data["major"],
+                    data.get("minor"),  # Optional field
+                ],
+            )
+            db.commit()
         return jsonify({"message": "POST request successful", "data": data}), 201
     except sqlite3.IntegrityError:
         return jsonify({"error": "Student with this email already exists"}), 400
@@ -375,27 +596,28 @@ def put_resource():
         return jsonify({"error": "Email not found in token"}), 401
 
     data = request.json
-    db = get_db()
-    db.execute(
-        """
-        UPDATE students 
-        SET name = ?, course = ?, enrollment_date = ?, expected_graduation = ?,
-            gpa = ?, credits_completed = ?, major = ?, minor = ?
-        WHERE email = ?
-    """,
-        [
-            data["name"],
-            data["course"],
-            data.get("enrollment_date"),
-            data.get("expected_graduation"),
-            data.get("gpa", 0.0),
-            data.get("credits_completed", 0),
-            data["major"],
-            data.get("minor"),
-            email,
-        ],
-    )
-    db.commit()
+    db, lock = get_shard(email)
+    with lock:
+        db.execute(
+            """
+            UPDATE students 
+            SET name = ?, course = ?, enrollment_date = ?, expected_graduation = ?,
+                gpa = ?, credits_completed = ?, major = ?, minor = ?
+            WHERE email = ?
+        """,
+            [
+                data["name"],
+                data["course"],
+                data.get("enrollment_date"),
+                data.get("expected_graduation"),
+                data.get("gpa", 0.0),
+                data.get("credits_completed", 0),
+                data["major"],
+                data.get("minor"),
+                email,
+            ],
+        )
+        db.commit()
     return jsonify({"message": "PUT request successful", "data": data})
 
 
@@ -436,10 +658,11 @@ def delete_resource():
     if not email:
         return jsonify({"error": "Email not found in token"}), 401
 
-    db = get_db()
-    cursor = db.cursor()
-    cursor.execute("DELETE FROM students WHERE email = ?", [email])
-    db.commit()
+    db, lock = get_shard(email)
+    with lock:
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM students WHERE email = ?", [email])
+        db.commit()
 
     # Check if any row was actually deleted
     if cursor.rowcount == 0:
@@ -448,5 +671,46 @@ def delete_resource():
     return jsonify({"message": "DELETE request successful"}), 200
 
 
+@app.route("/api/resource/export", methods=["GET"])
+def export_resources():
+    """
+    Export every student record across all shards.
+    ---
+    tags:
+      - Student Resources
+    security:
+      - Bearer: []
+    responses:
+      200:
+        description: >-
+          All student records, ordered by email. Each `id` is only unique
+          within its shard, so records should be keyed by email.
+      401:
+        description: Unauthorized - Invalid or missing token
+      403:
+        description: Forbidden - Insufficient permissions
+    """
+    auth_header = request.headers.get("Authorization")
+    if not auth_header:
+        return jsonify({"error": "Missing Authorization header"}), 401
+
+    decoded_token = validate_token(auth_header)
+    if not decoded_token:
+        return jsonify({"error": "Invalid or expired token"}), 401
+
+    roles = (
+        decoded_token.get("resource_access", {}).get(CLIENT_ID, {}).get("roles", [])
+    )
+    if "Lecturer" not in roles:
+        return jsonify({"error": "Insufficient permissions"}), 403
+
+    # Each shard sorts its own rows; the merge keeps the global email order
+    students = query_all_shards(
+        "SELECT * FROM students ORDER BY email", key=lambda row: row["email"]
+    )
+
+    return stream_json_list(students, message="GET request successful")
+
+
 if __name__ == "__main__":
     app.run(debug=True, port=5001)
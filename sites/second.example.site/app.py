@@ -7,17 +7,54 @@ from flask import (
     request,
     flash,
     jsonify,
+    stream_with_context,
 )
+from flask.json.provider import DefaultJSONProvider
 from flask_oidc import OpenIDConnect
 from flask_sqlalchemy import SQLAlchemy
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz, jwt, json
 import os
+import threading
+import base64, bisect, queue
+
+try:
+    import orjson  # Optional: much faster than the stdlib encoder
+except ImportError:
+    orjson = None
 
 client_secrets = json.load(open("client_secrets.json"))
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that encodes and decodes with orjson.
+
+    Dates are handed back to Flask's default handler, so they serialize the
+    same way as with the stdlib provider. Output is always compact: options
+    passed to dumps() such as indent are ignored.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return self._encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._encode(obj), mimetype=self.mimetype)
+
+    def _encode(self, obj):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option)
+
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 app.config.update(
     {
         "SECRET_KEY": os.environ.get("FLASK_SECRET_KEY", os.urandom(24)),
@@ -52,6 +89,165 @@ class Scholarship(db.Model):
     deadline = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_scholarship_deadline_email", "deadline", "email"),
+    )
+
+
+PRIVATE_CACHE_CONTROL = "private, no-store"
+
+# Cache-Control and surrogate keys for pages the proxy may cache. They only
+# apply to anonymous visitors; everything else gets PRIVATE_CACHE_CONTROL.
+CACHE_POLICIES = {
+    "home": ("public, max-age=0, s-maxage=10", ["pages"]),
+    "public": ("public, max-age=60, s-maxage=60", ["pages"]),
+}
+
+
+@app.after_request
+def set_cache_headers(response):
+    policy = CACHE_POLICIES.get(request.endpoint)
+    response.vary.add("Cookie")
+    if policy is None or oidc.user_loggedin or response.status_code != 200:
+        response.headers["Cache-Control"] = PRIVATE_CACHE_CONTROL
+        return response
+    cache_control, keys = policy
+    response.headers["Cache-Control"] = cache_control
+    response.headers["Surrogate-Key"] = " ".join(keys)
+    return response
+
+
+class DeadlineIndex:
+    """Scholarships with a deadline, kept sorted by (deadline, email, id).
+
+    Loaded once from the database, then updated in place whenever a
+    scholarship is written, so the deadline feed never queries per request.
+    Open SSE streams subscribe here to be told about every change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []  # sorted (deadline, email, id)
+        self._by_email = {}  # email -> that user's keys, same order
+        self._entries = {}  # id -> (key, entry)
+        self._subscribers = []
+        self._loaded = False
+
+    def _load(self):
+        rows = (
+            Scholarship.query.filter(Scholarship.deadline.isnot(None))
+            .order_by(Scholarship.deadline, Scholarship.email, Scholarship.id)
+            .all()
+        )
+        for scholarship in rows:
+            key, entry = self._make_entry(scholarship)
+            self._keys.append(key)
+            self._by_email.setdefault(key[1], []).append(key)
+            self._entries[scholarship.id] = (key, entry)
+        self._loaded = True
+
+    @staticmethod
+    def _make_entry(scholarship):
+        key = (scholarship.deadline, scholarship.email, scholarship.id)
+        entry = {
+            "id": scholarship.id,
+            "title": scholarship.title,
+            "amount": scholarship.amount,
+            "email": scholarship.email,
+            "deadline": scholarship.deadline.isoformat(),
+        }
+        return key, entry
+
+    def _discard(self, id):
+        old = self._entries.pop(id, None)
+        if old is not None:
+            key = old[0]
+            del self._keys[bisect.bisect_left(self._keys, key)]
+            keys = self._by_email[key[1]]
+            del keys[bisect.bisect_left(keys, key)]
+            if not keys:
+                del self._by_email[key[1]]
+        return old
+
+    def _publish(self, event, entry, deadline=None):
+        for subscriber in self._subscribers:
+            subscriber.put((event, deadline, entry))
+
+    def upsert(self, scholarship):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._discard(scholarship.id)
+            if scholarship.deadline is None:
+                self._publish("delete", {"id": scholarship.id, "email": scholarship.email})
+                return
+            key, entry = self._make_entry(scholarship)
+            bisect.insort(self._keys, key)
+            bisect.insort(self._by_email.setdefault(key[1], []), key)
+            self._entries[scholarship.id] = (key, entry)
+            self._publish("upsert", entry, key[0])
+
+    def remove(self, id):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            old = self._discard(id)
+            if old is not None:
+                self._publish("delete", {"id": id, "email": old[1]["email"]})
+
+    def window(self, start, end, after=None, email=None, limit=50):
+        """Return up to `limit` entries due in [start, end], after cursor key `after`."""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            keys = self._keys if email is None else self._by_email.get(email, [])
+            if after is None:
+                i = bisect.bisect_left(keys, (start,))
+            else:
+                i = bisect.bisect_right(keys, max(after, (start,)))
+            page = []
+            while i < len(keys) and keys[i][0] <= end and len(page) < limit:
+                page.append(self._entries[keys[i][2]][1])
+                i += 1
+            return page
+
+    def subscribe(self):
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.remove(subscriber)
+
+
+deadline_index = DeadlineIndex()
+
+
+def encode_deadline_cursor(entry):
+    raw = json.dumps([entry["deadline"], entry["email"], entry["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_deadline_cursor(cursor):
+    value = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not (
+        isinstance(value, list)
+        and len(value) == 3
+        and isinstance(value[0], str)
+        and isinstance(value[1], str)
+        and type(value[2]) is int
+    ):
+        raise ValueError("Malformed cursor")
+    deadline, email, id = value
+    deadline = datetime.fromisoformat(deadline)
+    if deadline.tzinfo is not None:
+        # Stored deadlines are naive, and cannot be compared with aware ones
+        raise ValueError("Malformed cursor")
+    return (deadline, email, id)
+
+
 @app.route("/")
 def home():
     print('check_login:', oidc.user_loggedin)
@@ -202,6 +398,77 @@ def scholarships():
     )
 
 
+@app.route("/scholarships/deadlines")
+@oidc.require_login
+def scholarship_deadlines():
+    """Upcoming scholarship deadlines, soonest first.
+
+    Query parameters: `days` (window size, default 30), `limit` (page size,
+    default 50), `cursor` (from the previous page's `next_cursor`) and
+    `stream=1` to receive the window and later changes as server-sent events.
+    """
+    info = oidc.user_getinfo(["email"])
+    user_email = info.get("email")
+    is_lecturer = "lecturer" in get_user_roles(oidc.get_access_token())
+    # Students only see their own scholarships, as on the list page
+    email = None if is_lecturer else user_email
+
+    try:
+        days = max(0, min(int(request.args.get("days", 30)), 365))
+        limit = max(1, min(int(request.args.get("limit", 50)), 200))
+        cursor = request.args.get("cursor")
+        after = decode_deadline_cursor(cursor) if cursor else None
+    except ValueError:
+        return jsonify({"error": "Invalid days, limit or cursor"}), 400
+
+    def window_start():
+        return datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if request.args.get("stream") != "1":
+        start = window_start()
+        page = deadline_index.window(
+            start, start + timedelta(days=days), after=after, email=email, limit=limit
+        )
+        next_cursor = encode_deadline_cursor(page[-1]) if len(page) == limit else None
+        return jsonify({"data": page, "next_cursor": next_cursor})
+
+    def event(name, data):
+        return f"event: {name}\ndata: {app.json.dumps(data)}\n\n"
+
+    def generate():
+        subscriber = deadline_index.subscribe()
+        try:
+            start = window_start()
+            snapshot = deadline_index.window(
+                start, start + timedelta(days=days), email=email, limit=limit
+            )
+            yield event("snapshot", snapshot)
+            while True:
+                try:
+                    name, deadline, entry = subscriber.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if email is not None and entry["email"] != email:
+                    continue
+                start = window_start()
+                if name == "upsert" and not (
+                    start <= deadline <= start + timedelta(days=days)
+                ):
+                    # Moved out of the window: dashboards should drop it
+                    name, entry = "delete", {"id": entry["id"], "email": entry["email"]}
+                yield event(name, entry)
+        finally:
+            deadline_index.unsubscribe(subscriber)
+
+    response = app.response_class(
+        stream_with_context(generate()), mimetype="text/event-stream"
+    )
+    # Let nginx pass events through as they are written
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @app.route("/scholarship/add", methods=["GET", "POST"])
 @oidc.require_login
 def add_scholarship():
@@ -220,6 +487,7 @@ def add_scholarship():
         )
         db.session.add(scholarship)
         db.session.commit()
+        deadline_index.upsert(scholarship)
         flash("Scholarship added successfully!", "success")
         return redirect(url_for("scholarships"))
 
@@ -243,6 +511,7 @@ def edit_scholarship(id):
         scholarship.description = request.form["description"]
         scholarship.deadline = datetime.strptime(request.form["deadline"], "%Y-%m-%d")
         db.session.commit()
+        deadline_index.upsert(scholarship)
         flash("Scholarship updated successfully!", "success")
         return redirect(url_for("scholarships"))
 
@@ -261,6 +530,7 @@ def delete_scholarship(id):
 
     db.session.delete(scholarship)
     db.session.commit()
+    deadline_index.remove(id)
     flash("Scholarship deleted successfully!", "success")
     return redirect(url_for("scholarships"))
 
@@ -268,6 +538,9 @@ def delete_scholarship(id):
 # Add this at the end of the file
 with app.app_context():
     db.create_all()
+    # create_all() skips indexes on tables that already exist
+    for index in Scholarship.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
 
 if __name__ == "__main__":
     app.run(debug=True, port=5000)